@@ -10,15 +10,33 @@ FastAPI backend that proxies Google Gemini 2.5 Flash with:
 - Lightweight category tagging + rich metadata for dashboard insights
 """
 
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any, Tuple
-from datetime import datetime
+from pydantic.json_schema import models_json_schema
+from typing import List, Optional, Dict, Any, Tuple, Final
+from datetime import datetime, timezone
+import asyncio
+import hashlib
+import logging
 import os
-import time
 import re
-import requests
+import tempfile
+import textwrap
+import time
+import zipfile
+import ahocorasick
+import anyio
+import httpx
+import orjson
+import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from cachetools import TTLCache
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
 # -----------------------------
@@ -27,9 +45,82 @@ from dotenv import load_dotenv
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-pro")
-GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+GEMINI_URL = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent"
+GEMINI_STREAM_URL = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse"
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+# Seconds Gemini keeps the prompt; clamped so the refresh interval below stays well above zero
+CONTEXT_CACHE_TTL = max(int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600")), 300)
+CONTEXT_CACHE_REFRESH = max(CONTEXT_CACHE_TTL - 600, CONTEXT_CACHE_TTL // 2)  # extend well before expiry
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT = 0.25  # seconds; an unreachable Redis should cost a cache miss, not the request
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # min cosine similarity
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))  # seconds an answer may be reused
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fail at boot rather than on the first /ask when the deployment is misconfigured
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY not set")
+    # run_in_threadpool (post-processing, embeddings) shares AnyIO's limiter, 40 threads by default
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100
+    # One shared async client per process: keeps connections to Gemini warm
+    # and lets the event loop serve other requests while a call is in flight.
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        http2=True,
+        # Answers are long markdown that compresses well; brotli support comes from httpx[brotli]
+        # The key travels as a default header, so no per-request URL needs it
+        headers={
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, br",
+            "x-goog-api-key": GEMINI_API_KEY,
+        },
+        # httpx drops idle connections after 5s by default; keep them for a minute so
+        # requests spaced out under light traffic still skip the TCP+TLS handshake
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60),
+    )
+    # Optional shared response cache, so workers and restarts reuse each other's answers
+    app.state.redis = redis.from_url(
+        REDIS_URL,
+        socket_timeout=REDIS_TIMEOUT,
+        socket_connect_timeout=REDIS_TIMEOUT,
+        # redis-py otherwise retries connection errors 10 times with backoff
+        retry=Retry(NoBackoff(), 0),
+    ) if REDIS_URL else None
+    app.state.semantic_cache = None
+    if SEMANTIC_CACHE_ENABLED:
+        try:
+            # Loading the embedding model takes seconds; keep it off the loop
+            app.state.semantic_cache = await asyncio.to_thread(SemanticCache.load, SEMANTIC_CACHE_DIR)
+        except ImportError:
+            logger.warning("Semantic cache disabled: install requirements-semantic.txt to enable it")
+    app.state.cached_prompt = None
+    prompt_cache_task = None
+    if CONTEXT_CACHE_ENABLED:
+        prompt_cache_task = asyncio.create_task(keep_prompt_cache_fresh())
+    try:
+        yield
+    finally:
+        if prompt_cache_task is not None:
+            prompt_cache_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await prompt_cache_task
+            if app.state.cached_prompt is not None:
+                await delete_prompt_cache(app.state.cached_prompt)
+                app.state.cached_prompt = None
+        if app.state.semantic_cache is not None:
+            await app.state.semantic_cache.save()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+        await app.state.http.aclose()
 
 app = FastAPI(
+    lifespan=lifespan,
     title="Clau Financial Advisory API",
     description="AI-powered financial advisory chatbot backend",
     version="1.2.0",
@@ -56,12 +147,15 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     answer: str
-    meta: Dict[str, Any]        # category, has_disclaimer, retries, model, response_length, timestamp
+    meta: Dict[str, Any]        # category, has_disclaimer, retries, model, response_length, cache, timestamp
+
+class ErrorResponse(BaseModel):
+    detail: str                 # HTTPException message
 
 # -----------------------------
 # System Prompt (financial)
 # -----------------------------
-SYSTEM_PROMPT = """
+SYSTEM_PROMPT: Final[str] = """
 You are a professional, helpful, and highly knowledgeable financial advisor chatbot named "Clau".
 Your primary goal is to provide accurate, clear, and concise financial guidance.
 
@@ -93,7 +187,10 @@ Responsibilities:
 8) End with a bold Final Recommendation line, e.g., **Final Recommendation: Save $200 and cap wants at $300.**
 """
 
-DISCLAIMER_TEXT = (
+# Sent as Gemini's native system instruction instead of being prepended to the user turn
+SYSTEM_INSTRUCTION: Final[Dict[str, Any]] = {"parts": [{"text": SYSTEM_PROMPT}]}
+
+DISCLAIMER_TEXT: Final[str] = (
     "Disclaimer: This is for informational purposes only and not professional financial advice. "
     "Consult a certified financial planner or tax professional for personalized guidance."
 )
@@ -101,51 +198,75 @@ DISCLAIMER_TEXT = (
 # -----------------------------
 # Helpers: category, disclaimer
 # -----------------------------
-INVESTMENT_KEYWORDS = [
+INVESTMENT_KEYWORDS = frozenset({
     "stock", "stocks", "bond", "bonds", "mutual fund", "etf", "portfolio",
     "asset allocation", "diversification", "brokerage", "retirement", "401(k)",
     "roth", "ira", "market", "equity", "securities", "dividend"
-]
+})
 
+# Insertion order is the priority when several categories match
 CATEGORY_MAP = {
-    "personal_finance": [
+    "personal_finance": frozenset({
         "budget", "budgeting", "save", "saving", "debt", "loan", "rent", "groceries",
         "emergency fund", "expense", "utilities", "credit score", "dti", "spend"
-    ],
+    }),
     "investments": INVESTMENT_KEYWORDS,
-    "financial_planning": [
+    "financial_planning": frozenset({
         "retirement", "401(k)", "roth", "ira", "college", "529", "pension",
         "estate", "insurance", "planning", "goal"
-    ],
-    "financial_literacy": [
+    }),
+    "financial_literacy": frozenset({
         "compound interest", "apr", "apy", "rule of 72", "inflation", "amortization",
         "interest rate", "depreciation"
-    ],
-    "market_trends": [
+    }),
+    "market_trends": frozenset({
         "cpi", "inflation", "interest rates", "fed", "gdp", "unemployment",
         "oil prices", "market trend", "economic indicator", "yield curve", "central bank"
-    ],
+    }),
 }
+CATEGORY_ORDER = tuple(CATEGORY_MAP)
+
+def _build_automaton(keyword_map: Dict[str, frozenset]) -> "ahocorasick.Automaton":
+    """
+    Compile keyword sets into one Aho-Corasick automaton so a single pass over
+    the text finds every hit. Each keyword maps to the rank (position in
+    keyword_map) of the highest-priority category that uses it.
+    """
+    ranks: Dict[str, int] = {}
+    for rank, keys in enumerate(keyword_map.values()):
+        for k in keys:
+            ranks.setdefault(k, rank)
+    automaton = ahocorasick.Automaton()
+    for k, rank in ranks.items():
+        automaton.add_word(k, rank)
+    automaton.make_automaton()
+    return automaton
+
+CATEGORY_AUTOMATON = _build_automaton(CATEGORY_MAP)
+INVESTMENT_AUTOMATON = _build_automaton({"investments": INVESTMENT_KEYWORDS})
 
 def detect_category(text: str) -> str:
-    t = text.lower()
-    for cat, keys in CATEGORY_MAP.items():
-        if any(k in t for k in keys):
-            return cat
-    if any(k in t for k in INVESTMENT_KEYWORDS):
-        return "investments"
-    return "personal_finance"
+    best = len(CATEGORY_ORDER)
+    for _, rank in CATEGORY_AUTOMATON.iter(text.lower()):
+        if rank == 0:
+            return CATEGORY_ORDER[0]  # nothing outranks the first category; stop scanning
+        best = min(best, rank)
+    return CATEGORY_ORDER[best] if best < len(CATEGORY_ORDER) else "personal_finance"
 
 def is_investment_related(text: str) -> bool:
-    t = text.lower()
-    return any(k in t for k in INVESTMENT_KEYWORDS)
+    return next(INVESTMENT_AUTOMATON.iter(text.lower()), None) is not None
+
+# Both key phrases, in either order and any case, without lowercasing a copy of the answer
+DISCLAIMER_RE = re.compile(
+    r"(?=.*?informational purposes only)(?=.*?not professional financial advice)",
+    re.IGNORECASE | re.DOTALL,
+)
 
 def ensure_disclaimer(answer: str) -> Tuple[str, bool]:
     """
     Append disclaimer if content appears investment-related and disclaimer not already present.
     """
-    has = ("informational purposes only" in answer.lower()
-           and "not professional financial advice" in answer.lower())
+    has = DISCLAIMER_RE.match(answer) is not None
     if is_investment_related(answer) and not has:
         if not answer.endswith("\n"):
             answer += "\n"
@@ -153,206 +274,673 @@ def ensure_disclaimer(answer: str) -> Tuple[str, bool]:
         return answer, True
     return answer, has
 
+def utc_timestamp() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
 # -----------------------------
 # Post-processing: tables & formatting
 # -----------------------------
 TABLE_HEADER_RE = re.compile(r'^\|(.+?)\|\s*$', re.MULTILINE)
+SEP_RE = re.compile(r'^\|\s*:?-{3,}\s*(\|\s*:?-{3,}\s*)+\|?\s*$')
+URL_RE = re.compile(r'https?://')
 
-def _looks_like_separator(line: str) -> bool:
-    return bool(re.match(r'^\|\s*:?-{3,}\s*(\|\s*:?-{3,}\s*)+\|?\s*$', line.strip()))
+def _make_wrapper(width: int) -> textwrap.TextWrapper:
+    # Never split words or hyphenated terms; keep tabs and leading indentation as-is
+    return textwrap.TextWrapper(
+        width=width,
+        break_long_words=False,
+        break_on_hyphens=False,
+        replace_whitespace=False,
+        expand_tabs=False,
+    )
 
-def fix_markdown_tables(text: str) -> str:
-    """
-    Ensure any markdown table header line is followed by a separator line like:
-    |-----|-----|-----|
-    Only inserts if the immediate next non-empty line is not already a valid separator.
-    """
-    lines = text.splitlines()
-    out = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        out.append(line)
-        if '|' in line.strip() and TABLE_HEADER_RE.match(line.strip()):
-            j = i + 1
-            while j < len(lines) and lines[j].strip() == "":
-                out.append(lines[j])
-                j += 1
-            if j < len(lines):
-                next_line = lines[j]
-                if not _looks_like_separator(next_line):
-                    cols = [c.strip() for c in line.strip().split('|') if c.strip() != '']
-                    if cols:
-                        sep = "|" + "|".join(["----------"] * len(cols)) + "|"
-                        out.append(sep)
-            else:
-                cols = [c.strip() for c in line.strip().split('|') if c.strip() != '']
-                if cols:
-                    sep = "|" + "|".join(["----------"] * len(cols)) + "|"
-                    out.append(sep)
-        i += 1
-    return "\n".join(out)
+WRAP_WIDTH = 109
+LINE_WRAPPER = _make_wrapper(WRAP_WIDTH)
 
-BOLD_IN_CELL_RE = re.compile(r'(\|[^|\n]*?)\*\*(.+?)\*\*([^|\n]*?\|)')
+def _separator_for(header: str) -> str:
+    cols = [c.strip() for c in header.split('|') if c.strip() != '']
+    return "|" + "|".join(["----------"] * len(cols)) + "|" if cols else ""
 
-def strip_bold_inside_table_cells(text: str) -> str:
-    """
-    Remove **bold** inside table rows (leaves normal text), preserving outside-table bold.
-    """
-    def _replace_line(line: str) -> str:
-        # Don't modify header-separator lines
-        if _looks_like_separator(line):
-            return line
-        # Replace all bold segments inside cell content for the line
-        new_line = line
-        while True:
-            m = BOLD_IN_CELL_RE.search(new_line)
-            if not m:
-                break
-            new_line = new_line[:m.start()] + m.group(1) + m.group(2) + m.group(3) + new_line[m.end():]
-        return new_line
-
-    lines = text.splitlines()
-    for idx, line in enumerate(lines):
-        if line.strip().startswith("|"):
-            lines[idx] = _replace_line(line)
-    return "\n".join(lines)
-
-def soft_wrap_lines(text: str, max_len: int = 109) -> str:
+BOLD_IN_CELL_RE = re.compile(r'\*\*([^|\n]+?)\*\*(?=[^|\n]*\|)')
+
+def postprocess_markdown(text: str, max_len: int = WRAP_WIDTH) -> str:
     """
-    Soft-wrap lines to <= max_len chars, skipping:
-    - table lines (start with '|')
-    - table separator lines
-    - code fences and content within ``` blocks
-    - URLs (lines containing 'http'/'https')
-    - blockquote lines (start with '>')
+    Single pass over the answer that:
+    - inserts a header separator (|-----|-----|) after the first row of a table
+      when the next non-empty line is not already one
+    - removes **bold** inside table cells, preserving outside-table bold
+    - soft-wraps other lines to <= max_len chars, skipping blockquotes and URLs
+    Content within ``` code fences is passed through untouched.
     """
-    out = []
+    wrapper = LINE_WRAPPER if max_len == WRAP_WIDTH else _make_wrapper(max_len)
+    out: List[str] = []
     in_code = False
+    in_table = False        # previous line was a table row
+    pending_sep = ""        # separator owed to a header whose next line is not seen yet
     for line in text.splitlines():
         striped = line.strip()
+        if pending_sep and striped:
+            if not SEP_RE.match(striped):
+                out.append(pending_sep)
+            pending_sep = ""
+
         if striped.startswith("```"):
             out.append(line)
             in_code = not in_code
+            in_table = False
             continue
-        if in_code or striped.startswith("|") or _looks_like_separator(line) or striped.startswith(">"):
+        if in_code:
             out.append(line)
             continue
-        if "http://" in line or "https://" in line:
-            out.append(line)
+
+        if striped.startswith("|"):
+            if SEP_RE.match(striped):
+                out.append(line)
+            else:
+                if not in_table and TABLE_HEADER_RE.match(striped):
+                    pending_sep = _separator_for(striped)
+                out.append(BOLD_IN_CELL_RE.sub(r"\1", line))
+            in_table = True
             continue
+        in_table = False
 
-        if len(line) <= max_len:
+        if len(line) <= max_len or striped.startswith(">") or URL_RE.search(line):
             out.append(line)
             continue
 
-        # wrap by words
-        words = line.split(" ")
-        cur = ""
-        for w in words:
-            if len(cur) + (1 if cur else 0) + len(w) <= max_len:
-                cur = w if not cur else f"{cur} {w}"
-            else:
-                out.append(cur)
-                cur = w
-        if cur:
-            out.append(cur)
+        out.extend(wrapper.wrap(line))
+
+    if pending_sep:
+        out.append(pending_sep)
     return "\n".join(out)
 
 # -----------------------------
 # Gemini call with retries
 # -----------------------------
-def call_gemini(payload: Dict[str, Any], max_retries: int = 3, base_delay: float = 0.8) -> Dict[str, Any]:
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+MAX_RETRY_AFTER = 10.0
+
+class RetryableStatus(Exception):
+    """Transient Gemini status (rate limit / 5xx); carries the response for the final error."""
+    def __init__(self, resp: httpx.Response):
+        super().__init__(resp.status_code)
+        self.response = resp
+        try:
+            self.retry_after: Optional[float] = min(float(resp.headers["retry-after"]), MAX_RETRY_AFTER)
+        except (KeyError, ValueError):
+            self.retry_after = None
+
+def _gemini_wait(base_delay: float):
+    backoff = wait_exponential(multiplier=base_delay)
+
+    def wait(retry_state: RetryCallState) -> float:
+        # Honour Retry-After on 429/503 when Gemini sends one, else exponential backoff
+        retry_after = getattr(retry_state.outcome.exception(), "retry_after", None)
+        return retry_after if retry_after is not None else backoff(retry_state)
+    return wait
+
+async def call_gemini(payload: Dict[str, Any], max_retries: int = 3, base_delay: float = 0.8) -> Dict[str, Any]:
+    body = orjson.dumps(payload)
+    retrying = AsyncRetrying(
+        stop=stop_after_attempt(max_retries),
+        wait=_gemini_wait(base_delay),
+        retry=retry_if_exception_type((RetryableStatus, httpx.RequestError)),
+        reraise=True,
+    )
+    try:
+        async for attempt in retrying:
+            with attempt:
+                resp = await app.state.http.post(GEMINI_URL, content=body)
+                if resp.status_code in RETRYABLE_STATUS:
+                    raise RetryableStatus(resp)
+    except RetryableStatus as exc:
+        raise HTTPException(status_code=502, detail=exc.response.text or "AI service temporarily unavailable")
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Request to AI service timed out")
+    except httpx.RequestError:
+        raise HTTPException(status_code=502, detail="AI service temporarily unavailable")
+
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    try:
+        result = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=502, detail="Invalid response from AI service")
+    return {"json": result, "retries": attempt.retry_state.attempt_number - 1}
+
+# -----------------------------
+# Gemini context cache (system prompt)
+# -----------------------------
+async def create_prompt_cache() -> Optional[str]:
+    """
+    Store the system instruction server-side as a Gemini cachedContent and return its name,
+    or None if Gemini refuses (e.g. the prompt is below the model's minimum cacheable size).
+    """
+    body = {
+        "model": f"models/{GEMINI_MODEL}",
+        "systemInstruction": SYSTEM_INSTRUCTION,
+        "ttl": f"{CONTEXT_CACHE_TTL}s",
+    }
+    try:
+        resp = await app.state.http.post(
+            f"{GEMINI_API_BASE}/cachedContents",
+            content=orjson.dumps(body),
+        )
+    except httpx.RequestError as exc:
+        logger.warning("Could not create Gemini context cache: %s", exc)
+        return None
+    if resp.status_code != 200:
+        logger.warning("Could not create Gemini context cache (%s): %s", resp.status_code, resp.text)
+        return None
+    try:
+        return orjson.loads(resp.content)["name"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        logger.warning("Unexpected Gemini context cache response: %s", resp.text)
+        return None
 
-    headers = {"Content-Type": "application/json"}
-    last_err_text = ""
-    for attempt in range(1, max_retries + 1):
+async def extend_prompt_cache(name: str) -> bool:
+    """
+    Push the expiry of an existing cachedContent out by another TTL; False if it is gone.
+    """
+    try:
+        resp = await app.state.http.patch(
+            f"{GEMINI_API_BASE}/{name}?updateMask=ttl",
+            content=orjson.dumps({"ttl": f"{CONTEXT_CACHE_TTL}s"}),
+        )
+    except httpx.RequestError:
+        return False
+    return resp.status_code == 200
+
+async def delete_prompt_cache(name: str) -> None:
+    """
+    Delete a cachedContent on shutdown so a stopped worker stops paying for its copy.
+    """
+    try:
+        resp = await app.state.http.delete(f"{GEMINI_API_BASE}/{name}")
+    except httpx.RequestError as exc:
+        logger.warning("Could not delete Gemini context cache %s: %s", name, exc)
+        return
+    if resp.status_code != 200:
+        logger.warning("Could not delete Gemini context cache %s (%s): %s", name, resp.status_code, resp.text)
+
+async def keep_prompt_cache_fresh() -> None:
+    # Requests fall back to the inline systemInstruction whenever this is None
+    while True:
         try:
-            resp = requests.post(
-                f"{GEMINI_URL}?key={GEMINI_API_KEY}",
-                json=payload,
-                headers=headers,
-                timeout=30,
-            )
-            if resp.status_code == 200:
-                return {"json": resp.json(), "retries": attempt - 1}
-            if resp.status_code in (429, 500, 502, 503, 504):
-                last_err_text = resp.text
-                time.sleep(base_delay * (2 ** (attempt - 1)))
-                continue
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-        except requests.exceptions.Timeout:
-            if attempt == max_retries:
-                raise HTTPException(status_code=504, detail="Request to AI service timed out")
-            time.sleep(base_delay * (2 ** (attempt - 1)))
-        except requests.exceptions.RequestException:
-            if attempt == max_retries:
-                raise HTTPException(status_code=502, detail="AI service temporarily unavailable")
-            time.sleep(base_delay * (2 ** (attempt - 1)))
-    raise HTTPException(status_code=502, detail=last_err_text or "AI service temporarily unavailable")
+            name = app.state.cached_prompt
+            if name is None or not await extend_prompt_cache(name):
+                app.state.cached_prompt = await create_prompt_cache()
+        except Exception:
+            # Never leave requests pointing at an entry nobody is extending
+            logger.exception("Gemini context cache refresh failed")
+            app.state.cached_prompt = None
+        await asyncio.sleep(CONTEXT_CACHE_REFRESH)
 
 # -----------------------------
-# Routes
+# Response cache (exact match)
 # -----------------------------
-@app.get("/")
-def health_check():
-    return {"message": "Financial Advisory Chatbot Backend is running"}
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=RESPONSE_CACHE_TTL)
+# Cache key -> future resolved with (answer, meta) by the request currently calling Gemini
+INFLIGHT: Dict[str, "asyncio.Future[Tuple[str, Dict[str, Any]]]"] = {}
 
-@app.post("/ask", response_model=ChatResponse)
-def ask_question(data: ChatRequest):
+def cache_key(contents: List[Dict[str, Any]]) -> str:
     """
-    Process financial advisory questions using Google Gemini API with:
-    - system prompt injection   
-    - retries
-    - table/disclaimer/bold-in-cell/line-wrap post-processing
-    - category tagging and rich metadata
+    Stable hash of (model, contents) so identical conversations share one cache entry.
+    The system prompt is fixed per process, so it is left out of the key.
     """
-    if not data.contents:
-        raise HTTPException(status_code=400, detail="contents cannot be empty")
+    blob = orjson.dumps({"model": GEMINI_MODEL, "contents": contents}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
 
-    # Inject system prompt by prepending it to the first user message
-    first_user = next((m for m in data.contents if m.role.lower() == "user"), None)
-    if first_user and first_user.parts and isinstance(first_user.parts[0], dict):
-        original = first_user.parts[0].get("text", "")
-        first_user.parts[0]["text"] = f"{SYSTEM_PROMPT}\n\nUser question:\n{original}"
+async def redis_get_answer(key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    client = getattr(app.state, "redis", None)
+    if client is None:
+        return None
+    try:
+        raw = await client.get(f"clau:answer:{key}")
+    except redis.RedisError as exc:
+        logger.warning("Redis cache read failed: %s", exc)
+        return None
+    if raw is None:
+        return None
+    try:
+        text, meta = orjson.loads(raw)
+    except (ValueError, TypeError):
+        logger.warning("Ignoring corrupt Redis cache entry %s", key)
+        return None
+    return text, meta
+
+async def redis_set_answer(key: str, text: str, meta: Dict[str, Any]) -> None:
+    client = getattr(app.state, "redis", None)
+    if client is None:
+        return
+    try:
+        await client.set(f"clau:answer:{key}", orjson.dumps([text, meta]), ex=RESPONSE_CACHE_TTL)
+    except redis.RedisError as exc:
+        logger.warning("Redis cache write failed: %s", exc)
 
-    payload = {"contents": [m.model_dump() for m in data.contents]}
+# -----------------------------
+# Semantic cache (near-duplicate questions)
+# -----------------------------
+# (answer, meta, created-at epoch seconds); entries are kept in insertion order
+SemanticEntry = Tuple[str, Dict[str, Any], float]
 
-    result = call_gemini(payload)
-    retries_used = result["retries"]
-    raw = result["json"]
+class SemanticCache:
+    """
+    Embedding index over previously answered single-turn questions.
+    A lookup returns the stored (answer, meta) when cosine similarity >= threshold
+    and the answer is younger than the TTL.
+    Optional dependencies (sentence-transformers, faiss, numpy) are imported lazily.
+    """
+    MODEL_NAME = "all-MiniLM-L6-v2"
+    THRESHOLD = SEMANTIC_CACHE_THRESHOLD
+    TTL = SEMANTIC_CACHE_TTL
+    MAX_ENTRIES = 10_000
+    PERSIST_EVERY = 50
+    FILE_NAME = "cache.npz"
+    # Market answers go stale within hours; reusing one for a reworded question is never safe
+    UNCACHED_CATEGORIES = frozenset({"market_trends"})
+
+    def __init__(self, encoder, index, entries: List[SemanticEntry], path: str):
+        self.encoder = encoder
+        self.index = index
+        self.entries = entries
+        self.path = path
+        self._unsaved = 0
+
+    @classmethod
+    def load(cls, path: str) -> "SemanticCache":
+        from sentence_transformers import SentenceTransformer
+
+        encoder = SentenceTransformer(cls.MODEL_NAME)
+        index, entries = cls.read(path, encoder.get_sentence_embedding_dimension())
+        return cls(encoder, index, entries, path)
+
+    @classmethod
+    def read(cls, path: str, dim: int) -> Tuple[Any, List[SemanticEntry]]:
+        """
+        Rebuild the index from the persisted file, dropping expired entries. A missing,
+        unreadable or inconsistent file yields an empty index: a vector paired with the
+        wrong entry would serve the answer to a different question.
+        """
+        import faiss
+        import numpy as np
+
+        index = faiss.IndexFlatIP(dim)
+        file = os.path.join(path, cls.FILE_NAME)
+        try:
+            with np.load(file) as data:
+                vectors = data["vectors"]
+                entries = [(answer, meta, float(created))
+                           for answer, meta, created in orjson.loads(data["entries"].tobytes())]
+        except FileNotFoundError:
+            return index, []
+        except (OSError, ValueError, TypeError, KeyError, zipfile.BadZipFile) as exc:
+            logger.warning("Ignoring unreadable semantic cache %s: %s", file, exc)
+            return index, []
+        if vectors.shape != (len(entries), dim):
+            logger.warning("Ignoring inconsistent semantic cache %s", file)
+            return index, []
+        fresh = cls._first_fresh(entries)
+        index.add(vectors[fresh:])
+        return index, entries[fresh:]
+
+    @classmethod
+    def _first_fresh(cls, entries: List[SemanticEntry]) -> int:
+        """Position of the oldest unexpired entry; everything before it has expired."""
+        cutoff = time.time() - cls.TTL
+        return next((i for i, e in enumerate(entries) if e[2] >= cutoff), len(entries))
+
+    def _drop_oldest(self, count: int) -> None:
+        import faiss
+
+        # Flat index ids are positions, so dropping a prefix keeps them aligned with entries
+        self.index.remove_ids(faiss.IDSelectorRange(0, count))
+        del self.entries[:count]
+
+    def _expire(self) -> None:
+        stale = self._first_fresh(self.entries)
+        if stale:
+            self._drop_oldest(stale)
+
+    def embed(self, text: str):
+        # Normalized vectors make inner product equal to cosine similarity
+        return self.encoder.encode([text], normalize_embeddings=True).astype("float32")
+
+    def search(self, vec) -> Optional[Tuple[str, Dict[str, Any]]]:
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(vec, 1)
+        if scores[0][0] < self.THRESHOLD:
+            return None
+        answer, meta, created = self.entries[ids[0][0]]
+        if created < time.time() - self.TTL:
+            return None
+        return answer, meta
+
+    def add(self, vec, answer: str, meta: Dict[str, Any]) -> bool:
+        """Index a new answer; True once enough are unsaved that the caller should save()."""
+        if meta.get("category") in self.UNCACHED_CATEGORIES:
+            return False
+        self._expire()
+        if self.index.ntotal >= self.MAX_ENTRIES:
+            # Still full of unexpired answers: make room by evicting the oldest tenth
+            self._drop_oldest(max(1, self.MAX_ENTRIES // 10))
+        self.index.add(vec)
+        self.entries.append((answer, meta, time.time()))
+        self._unsaved += 1
+        return self._unsaved >= self.PERSIST_EVERY
+
+    async def save(self) -> None:
+        """
+        Persist the unexpired entries without blocking the loop: vectors and entries are
+        copied here, the (multi-MB) write runs in a worker thread.
+        """
+        if not self._unsaved:
+            return
+        self._unsaved = 0
+        self._expire()
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        try:
+            await asyncio.to_thread(self._write, vectors, list(self.entries))
+        except OSError as exc:
+            logger.warning("Semantic cache save failed: %s", exc)
 
-    # Parse Gemini response
+    def _write(self, vectors, entries: List[SemanticEntry]) -> None:
+        import numpy as np
+
+        os.makedirs(self.path, exist_ok=True)
+        # One file, written aside and renamed into place: a reader never sees a half-written
+        # cache, nor one worker's vectors next to another worker's entries
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, vectors=vectors, entries=np.frombuffer(orjson.dumps(entries), dtype=np.uint8))
+            os.replace(tmp, os.path.join(self.path, self.FILE_NAME))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+# -----------------------------
+# Request / answer assembly
+# -----------------------------
+# ChatRequest still documents the body in OpenAPI; /ask parses it without a Pydantic round-trip
+CHAT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/ChatRequest"}}},
+    }
+}
+# parse_contents reports problems as a single detail string, not FastAPI's list of errors
+REQUEST_ERRORS: Dict[int, Dict[str, Any]] = {
+    400: {"model": ErrorResponse, "description": "Empty contents"},
+    422: {"model": ErrorResponse, "description": "Malformed request body"},
+}
+
+def openapi() -> Dict[str, Any]:
+    """
+    FastAPI's generated schema plus ChatRequest/Message, which no route takes as a
+    parameter and so would otherwise be missing from components.
+    """
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        _, defs = models_json_schema([(ChatRequest, "validation")], ref_template="#/components/schemas/{model}")
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(defs["$defs"])
+    return app.openapi_schema
+
+app.openapi = openapi
+
+def parse_contents(body: bytes) -> List[Dict[str, Any]]:
+    """
+    Validate a ChatRequest-shaped JSON body and return its contents ready for Gemini.
+    Messages are forwarded as-is; only unknown keys are dropped, as model_dump() did.
+    """
     try:
-        text = raw.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-    except Exception:
-        raise HTTPException(status_code=502, detail="Invalid response from AI service")
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="Request body must be valid JSON")
+    contents = data.get("contents") if isinstance(data, dict) else None
+    if not isinstance(contents, list):
+        raise HTTPException(status_code=422, detail="contents must be a list of messages")
 
-    if not text:
-        raise HTTPException(status_code=502, detail="AI service returned empty response")
+    out = []
+    for i, m in enumerate(contents):
+        if not (isinstance(m, dict) and isinstance(m.get("role"), str) and isinstance(m.get("parts"), list)
+                and all(isinstance(p, dict) for p in m["parts"])):
+            raise HTTPException(status_code=422, detail=f"contents[{i}] must have a string role and a list of parts")
+        # Post-processing and the semantic cache treat text as str; reject anything else up front
+        if not all(isinstance(p.get("text", ""), str) for p in m["parts"]):
+            raise HTTPException(status_code=422, detail=f"contents[{i}].parts[].text must be a string")
+        out.append(m if len(m) == 2 else {"role": m["role"], "parts": m["parts"]})
+    if not out:
+        raise HTTPException(status_code=400, detail="contents cannot be empty")
+    return out
+
+def build_payload(contents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    cached_prompt = getattr(app.state, "cached_prompt", None)
+    if cached_prompt:
+        return {"cachedContent": cached_prompt, "contents": contents}
+    return {"systemInstruction": SYSTEM_INSTRUCTION, "contents": contents}
 
-    # Post-processing pipeline
-    text = fix_markdown_tables(text)
-    text = strip_bold_inside_table_cells(text)
-    text = soft_wrap_lines(text, max_len=109)
+def first_user_text(contents: List[Dict[str, Any]]) -> str:
+    """
+    Text of the first user message; "" if there is none. Conversations almost
+    always open with the user turn, so contents[0] is checked before scanning.
+    """
+    if contents[0]["role"].lower() == "user":
+        first_user_idx = 0
+    else:
+        first_user_idx = next((i for i, m in enumerate(contents) if m["role"].lower() == "user"), -1)
+    if first_user_idx < 0 or not contents[first_user_idx]["parts"]:
+        return ""
+    return contents[first_user_idx]["parts"][0].get("text", "")
+
+def postprocess(text: str, user_text: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Run the post-processing pipeline on a raw Gemini answer and build its meta
+    (category, has_disclaimer, model, response_length). Per-request fields such as
+    retries, cache and timestamp are added by the caller.
+    """
+    text = postprocess_markdown(text)
     text, has_disclaimer = ensure_disclaimer(text)
 
     # Category tagging for dashboard (prefer user message for intent)
-    user_text = ""
-    if first_user and first_user.parts and isinstance(first_user.parts[0], dict):
-        user_text = first_user.parts[0].get("text", "")
-    category = detect_category(user_text or text)
-
-    # Meta for dashboard/insights
     meta = {
-        "category": category,
+        "category": detect_category(user_text or text),
         "has_disclaimer": has_disclaimer,
-        "retries": retries_used,
         "model": GEMINI_MODEL,
         "response_length": len(text),
-        "timestamp": datetime.utcnow().isoformat() + "Z",
     }
+    return text, meta
+
+# -----------------------------
+# Routes
+# -----------------------------
+@app.get("/")
+def health_check():
+    return {"message": "Financial Advisory Chatbot Backend is running"}
+
+async def generate_answer(payload: Dict[str, Any], key: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Produce the final answer and meta for a conversation that missed the in-process
+    cache: shared Redis cache, then semantic cache, then Gemini call and post-processing.
+    """
+    shared = await redis_get_answer(key)
+    if shared is not None:
+        text, meta = shared
+        RESPONSE_CACHE[key] = (text, meta)
+        return text, {**meta, "retries": 0, "cache": "hit", "timestamp": utc_timestamp()}
+
+    contents = payload["contents"]
+    user_text = first_user_text(contents)
+    # Only single-turn questions are matched semantically; follow-ups depend on context
+    question = user_text if len(contents) == 1 else ""
+
+    semantic = app.state.semantic_cache if question else None
+    if semantic is not None:
+        vec = await run_in_threadpool(semantic.embed, question)
+        found = semantic.search(vec)
+        if found is not None:
+            text, meta = found
+            # timestamp stays the time the answer was generated, so clients can see its age
+            return text, {**meta, "retries": 0, "cache": "semantic"}
+
+    result = await call_gemini(payload)
+    retries_used = result["retries"]
+    raw = result["json"]
+
+    # Parse Gemini response
+    try:
+        text = raw["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        text = ""
+
+    if not text:
+        raise HTTPException(status_code=502, detail="AI service returned empty response")
+
+    # CPU-bound on long answers; keep it off the event loop
+    text, meta = await run_in_threadpool(postprocess, text, user_text)
+    meta.update(retries=retries_used, cache="miss", timestamp=utc_timestamp())
+    RESPONSE_CACHE[key] = (text, meta)
+    await redis_set_answer(key, text, meta)
+    if semantic is not None and semantic.add(vec, text, meta):
+        await semantic.save()
+    return text, meta
+
+@app.post("/ask", response_model=ChatResponse, responses=REQUEST_ERRORS, openapi_extra=CHAT_REQUEST_BODY)
+async def ask_question(request: Request):
+    """
+    Process financial advisory questions using Google Gemini API with:
+    - system instruction (financial persona)
+    - exact-match (in-process + optional Redis) and semantic response caches
+    - single-flight coalescing of identical in-flight requests
+    - retries
+    - table/disclaimer/bold-in-cell/line-wrap post-processing
+    - category tagging and rich metadata
+    """
+    payload = build_payload(parse_contents(await request.body()))
+
+    key = cache_key(payload["contents"])
+    cached = RESPONSE_CACHE.get(key)
+    if cached is not None:
+        text, meta = cached
+        meta = {**meta, "retries": 0, "cache": "hit", "timestamp": utc_timestamp()}
+        return ChatResponse(answer=text, meta=meta)
+
+    # Single flight: identical conversations already in progress share one Gemini call
+    pending = INFLIGHT.get(key)
+    if pending is not None:
+        # shield: a disconnecting waiter must not cancel the shared future
+        text, meta = await asyncio.shield(pending)
+        meta = {**meta, "retries": 0, "cache": "coalesced", "timestamp": utc_timestamp()}
+        return ChatResponse(answer=text, meta=meta)
+
+    fut = asyncio.get_running_loop().create_future()
+    INFLIGHT[key] = fut
+    try:
+        text, meta = await generate_answer(payload, key)
+        fut.set_result((text, meta))
+    except Exception as exc:
+        fut.set_exception(exc)
+        fut.exception()  # mark retrieved so a lone failure isn't logged; waiters still get it
+        raise
+    finally:
+        if not fut.done():
+            # The leader was cancelled (client disconnected); fail the waiters with a
+            # retryable error rather than cancelling them along with it
+            fut.set_exception(HTTPException(status_code=503, detail="AI request was interrupted, please retry"))
+            fut.exception()
+        del INFLIGHT[key]
 
     return ChatResponse(answer=text, meta=meta)
+
+# no-cache: never replay a stream from an HTTP cache; X-Accel-Buffering: stop nginx-style
+# proxies (e.g. Render's) from buffering frames, which would defeat streaming
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.post("/ask/stream", responses=REQUEST_ERRORS, openapi_extra=CHAT_REQUEST_BODY)
+async def ask_question_stream(request: Request):
+    """
+    Stream the answer as Server-Sent Events while Gemini generates it:
+    - `data:` frames carry raw text chunks as {"text": "..."}
+    - a final `event: meta` frame carries the post-processed answer and metadata
+    - an `event: error` frame is sent if the upstream stream fails or is empty
+    Cached answers (exact or semantic match) are replayed as one data frame plus
+    the meta frame; streamed answers are added to the response caches once complete.
+    """
+    contents = parse_contents(await request.body())
+    key = cache_key(contents)
+    user_text = first_user_text(contents)
+    cached = RESPONSE_CACHE.get(key)
+    if cached is None:
+        cached = await redis_get_answer(key)
+        if cached is not None:
+            RESPONSE_CACHE[key] = cached
+    cache_state = "hit"
+
+    # Same single-turn rule as generate_answer
+    semantic = app.state.semantic_cache if len(contents) == 1 and user_text else None
+    vec = None
+    if cached is None and semantic is not None:
+        vec = await run_in_threadpool(semantic.embed, user_text)
+        cached = semantic.search(vec)
+        cache_state = "semantic"
+
+    if cached is not None:
+        text, meta = cached
+        meta = {**meta, "retries": 0, "cache": cache_state}
+        # As in generate_answer, a semantic match keeps the time its answer was generated
+        if cache_state == "hit":
+            meta["timestamp"] = utc_timestamp()
+
+        async def replay():
+            yield b"data: " + orjson.dumps({"text": text}) + b"\n\n"
+            yield b"event: meta\ndata: " + orjson.dumps({"answer": text, "meta": meta}) + b"\n\n"
+        return StreamingResponse(replay(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    upstream = app.state.http.build_request(
+        "POST",
+        GEMINI_STREAM_URL,
+        content=orjson.dumps(build_payload(contents)),
+    )
+    try:
+        resp = await app.state.http.send(upstream, stream=True)
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Request to AI service timed out")
+    except httpx.RequestError:
+        raise HTTPException(status_code=502, detail="AI service temporarily unavailable")
+    if resp.status_code != 200:
+        detail = (await resp.aread()).decode(errors="replace")
+        await resp.aclose()
+        raise HTTPException(status_code=resp.status_code, detail=detail)
+
+    async def events():
+        chunks: List[str] = []
+        try:
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    piece = orjson.loads(line[5:])["candidates"][0]["content"]["parts"][0]["text"]
+                except (orjson.JSONDecodeError, KeyError, IndexError, TypeError):
+                    continue
+                chunks.append(piece)
+                yield b"data: " + orjson.dumps({"text": piece}) + b"\n\n"
+        except httpx.HTTPError:
+            yield b"event: error\ndata: " + orjson.dumps({"detail": "AI service stream interrupted"}) + b"\n\n"
+            return
+        finally:
+            await resp.aclose()
+
+        if not chunks:
+            yield b"event: error\ndata: " + orjson.dumps({"detail": "AI service returned empty response"}) + b"\n\n"
+            return
+        text, meta = await run_in_threadpool(postprocess, "".join(chunks), user_text)
+        meta.update(retries=0, cache="miss", timestamp=utc_timestamp())
+        yield b"event: meta\ndata: " + orjson.dumps({"answer": text, "meta": meta}) + b"\n\n"
+        RESPONSE_CACHE[key] = (text, meta)
+        await redis_set_answer(key, text, meta)
+        if vec is not None and semantic.add(vec, text, meta):
+            await semantic.save()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
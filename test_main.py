@@ -7,12 +7,39 @@ with mocked external services.
 
 import pytest
 from fastapi.testclient import TestClient
+import main
 from main import app
 import httpx  # Import httpx for proper mocking
+import orjson
+import asyncio
+import json
+import time
 
 # Initialize test client for API testing
 client = TestClient(app)
 
+@pytest.fixture(autouse=True)
+def app_env(monkeypatch):
+    """Configure a Gemini key and start every test with empty per-process caches"""
+    monkeypatch.setattr(main, "GEMINI_API_KEY", "test-key")
+    main.RESPONSE_CACHE.clear()
+    main.INFLIGHT.clear()
+    yield
+    main.RESPONSE_CACHE.clear()
+    main.INFLIGHT.clear()
+
+def gemini_response(text):
+    """Gemini's nested generateContent response carrying a single text part"""
+    return httpx.Response(status_code=200, json={"candidates": [{"content": {"parts": [{"text": text}]}}]})
+
+def mock_gemini(text, calls=None):
+    """Stand-in for app.state.http.post answering with text; records each sent payload in calls"""
+    async def mock_post(url, **kwargs):
+        if calls is not None:
+            calls.append(orjson.loads(kwargs["content"]))
+        return gemini_response(text)
+    return mock_post
+
 def test_root():
     """Test health check endpoint functionality
     
@@ -23,50 +50,84 @@ def test_root():
     assert response.status_code == 200
     assert "running" in response.json().get("message", "").lower()
 
+def test_openapi_refs_resolve():
+    """Test that every $ref in the OpenAPI document points at a registered schema
+
+    /ask takes its body as raw JSON, so ChatRequest and Message have to be added
+    to components by hand; a dangling ref breaks /docs and generated clients.
+    """
+    schema = app.openapi()
+    registered = schema["components"]["schemas"]
+
+    def refs(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "$ref":
+                    yield value
+                else:
+                    yield from refs(value)
+        elif isinstance(node, list):
+            for item in node:
+                yield from refs(item)
+
+    found = list(refs(schema))
+    assert "#/components/schemas/ChatRequest" in found
+    for ref in found:
+        assert ref.startswith("#/components/schemas/")
+        assert ref.rsplit("/", 1)[1] in registered
+
 def test_ask_success(monkeypatch):
     """Test successful financial advice request with mocked Gemini API
     
     This test verifies the complete request flow using monkeypatch to mock
     the external API call for reliable testing.
     """
-    # This is the correct way to mock the client used by TestClient
-    def mock_post(url, json=None, headers=None):
-        # Simulate Gemini's nested response structure
-        mock_response_data = {
-            "candidates": [
-                {"content": {"parts": [{"text": "Budget 50/30/20 rule\n\n**Final Recommendation: Save 20% of income**"}]}}
-            ]
-        }
-        return httpx.Response(status_code=200, json=mock_response_data)
+    # Mock the shared async client the app opens in its lifespan
+    calls = []
+    mock_post = mock_gemini("Budget 50/30/20 rule\n\n**Final Recommendation: Save 20% of income**", calls)
 
-    # Replace httpx.post with our mock for this test
-    monkeypatch.setattr(httpx, "post", mock_post)
-    
-    # Test with typical financial question
-    response = client.post("/ask", json={
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": "How should I budget?"}]
-            }
-        ]
-    })
+    # Entering the client runs the lifespan, which creates app.state.http
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+
+        # Test with typical financial question
+        response = client.post("/ask", json={
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [{"text": "How should I budget?"}]
+                }
+            ]
+        })
     
     # Verify successful response with expected format
     assert response.status_code == 200
     assert "Final Recommendation" in response.json()["answer"]
+    # The system prompt travels separately; the user's message is sent untouched
+    assert calls[0]["systemInstruction"] == main.SYSTEM_INSTRUCTION
+    assert calls[0]["contents"][0]["parts"][0]["text"] == "How should I budget?"
 
 def test_ask_missing_api_key(monkeypatch):
     """Test error handling when Gemini API key is not configured
     
-    This test ensures the application fails gracefully when the required
-    API key is missing. This test is expected to pass by asserting the failure.
+    The key is validated once at startup, so a misconfigured deployment
+    fails at boot instead of on every request.
     """
     # Simulate missing API key scenario by setting it to an empty string
-    monkeypatch.setenv("GEMINI_API_KEY", "")
-    
+    monkeypatch.setattr(main, "GEMINI_API_KEY", "")
+
+    with pytest.raises(RuntimeError, match="GEMINI_API_KEY"):
+        with TestClient(app):
+            pass
+
+def test_ask_invalid_api_key(monkeypatch):
+    """Test that an upstream authentication error is surfaced to the caller
+
+    Non-retryable Gemini errors keep their status code and message so the
+    frontend can show what went wrong.
+    """
     # This mock will simulate an auth error from the real API
-    def mock_post_auth_error(url, json=None, headers=None):
+    async def mock_post_auth_error(url, **kwargs):
         error_response = {
             "error": {
                 "code": 401,
@@ -76,23 +137,594 @@ def test_ask_missing_api_key(monkeypatch):
         }
         return httpx.Response(status_code=401, json=error_response)
 
-    monkeypatch.setattr(httpx, "post", mock_post_auth_error)
+    monkeypatch.setattr(main, "GEMINI_API_KEY", "bad-key")
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post_auth_error)
 
-    response = client.post("/ask", json={
-        "contents": [{"role": "user", "parts": [{"text": "test"}]}]
-    })
-    
-    # The application should catch the error and return a 500 status
-    assert response.status_code == 500
+        response = client.post("/ask", json={
+            "contents": [{"role": "user", "parts": [{"text": "test"}]}]
+        })
+
+    assert response.status_code == 401
     assert "API key not valid" in response.json()["detail"]
 
 def test_ask_invalid_payload():
     """Test request validation with malformed payload
     
-    Verifies that Pydantic validation properly rejects invalid requests,
+    Verifies that request validation properly rejects invalid requests,
     which is crucial for API security and data integrity.
     """
     # Send request with invalid structure
     response = client.post("/ask", json={"invalid": "data"})
     # Should return 422 Unprocessable Entity for validation errors
     assert response.status_code == 422
+
+    # Non-string text would crash post-processing; it must be rejected, not a 500
+    response = client.post("/ask", json={"contents": [{"role": "user", "parts": [{"text": 123}]}]})
+    assert response.status_code == 422
+    assert response.json()["detail"] == "contents[0].parts[].text must be a string"
+
+def test_ask_cache_hit(monkeypatch):
+    """Test that an identical conversation is served from the response cache
+
+    The second request must not reach Gemini and should be tagged as a
+    cache hit in the response metadata.
+    """
+    calls = []
+    mock_post = mock_gemini("Keep 3-6 months of expenses in cash.", calls)
+
+    body = {"contents": [{"role": "user", "parts": [{"text": "How big should my emergency fund be?"}]}]}
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+        first = client.post("/ask", json=body)
+        second = client.post("/ask", json=body)
+
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.json()["meta"]["cache"] == "miss"
+    assert second.json()["meta"]["cache"] == "hit"
+    assert second.json()["answer"] == first.json()["answer"]
+    assert len(calls) == 1
+
+def test_ask_retries_transient_errors(monkeypatch):
+    """Test that transient Gemini errors are retried and counted in meta.retries"""
+    statuses = [503, 503, 200]
+
+    async def mock_post(url, **kwargs):
+        status = statuses.pop(0)
+        if status != 200:
+            return httpx.Response(status_code=status, text="Service Unavailable")
+        return gemini_response("Diversify across low-cost index funds.")
+
+    # Skip the real backoff sleeps
+    monkeypatch.setattr(main, "_gemini_wait", lambda base_delay: lambda retry_state: 0)
+
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+        response = client.post("/ask", json={
+            "contents": [{"role": "user", "parts": [{"text": "How should I diversify?"}]}]
+        })
+
+    assert response.status_code == 200
+    assert response.json()["meta"]["retries"] == 2
+    assert statuses == []
+
+def test_ask_upstream_timeout(monkeypatch):
+    """Test that a Gemini timeout that persists through retries maps to 504"""
+    calls = []
+
+    async def mock_post(url, **kwargs):
+        calls.append(url)
+        raise httpx.ReadTimeout("timed out")
+
+    monkeypatch.setattr(main, "_gemini_wait", lambda base_delay: lambda retry_state: 0)
+
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+        response = client.post("/ask", json={
+            "contents": [{"role": "user", "parts": [{"text": "Is gold a good hedge?"}]}]
+        })
+
+    assert response.status_code == 504
+    assert len(calls) == 3
+
+def test_ask_upstream_exhausted(monkeypatch):
+    """Test that a 5xx that persists through every retry maps to 502"""
+    calls = []
+
+    async def mock_post(url, **kwargs):
+        calls.append(url)
+        return httpx.Response(status_code=500, text="Internal error")
+
+    monkeypatch.setattr(main, "_gemini_wait", lambda base_delay: lambda retry_state: 0)
+
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+        response = client.post("/ask", json={
+            "contents": [{"role": "user", "parts": [{"text": "Should I refinance now?"}]}]
+        })
+
+    assert response.status_code == 502
+    assert response.json()["detail"] == "Internal error"
+    assert len(calls) == 3
+
+class FakeRedis:
+    """In-memory stand-in for the async Redis client; fail=True simulates an outage"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.store = {}
+
+    async def get(self, key):
+        if self.fail:
+            raise main.redis.ConnectionError("Redis unavailable")
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None):
+        if self.fail:
+            raise main.redis.ConnectionError("Redis unavailable")
+        self.store[key] = value
+
+    async def aclose(self):
+        pass
+
+def test_ask_redis_unavailable(monkeypatch):
+    """Test that a failing Redis only costs the shared cache, not the request"""
+    mock_post = mock_gemini("Automate transfers into savings on payday.")
+
+    body = {"contents": [{"role": "user", "parts": [{"text": "How can I save more each month?"}]}]}
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+        app.state.redis = FakeRedis(fail=True)
+        response = client.post("/ask", json=body)
+
+    assert response.status_code == 200
+    assert response.json()["meta"]["cache"] == "miss"
+
+def test_ask_redis_hit(monkeypatch):
+    """Test that an answer shared through Redis is served without calling Gemini
+
+    A corrupt entry must count as a miss rather than failing the request.
+    """
+    calls = []
+    mock_post = mock_gemini("Max out the employer match first.", calls)
+
+    contents = [{"role": "user", "parts": [{"text": "Should I invest in my 401k?"}]}]
+    key = f"clau:answer:{main.cache_key(contents)}"
+    fake = FakeRedis()
+    fake.store[key] = orjson.dumps(["Shared answer", {"category": "investing"}])
+
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_post)
+        app.state.redis = fake
+        hit = client.post("/ask", json={"contents": contents})
+
+        # /ask/stream keeps a Redis hit locally too, so repeats skip Redis
+        main.RESPONSE_CACHE.clear()
+        streamed = client.post("/ask/stream", json={"contents": contents})
+        assert main.cache_key(contents) in main.RESPONSE_CACHE
+
+        main.RESPONSE_CACHE.clear()
+        fake.store[key] = b"not json"
+        corrupt = client.post("/ask", json={"contents": contents})
+
+    assert hit.status_code == 200
+    assert hit.json()["answer"] == "Shared answer"
+    assert hit.json()["meta"]["cache"] == "hit"
+    assert "Shared answer" in streamed.text
+    assert corrupt.status_code == 200
+    assert corrupt.json()["meta"]["cache"] == "miss"
+    assert len(calls) == 1
+
+class StubSemanticCache:
+    """Stand-in for SemanticCache: "embeds" text as itself and matches exact questions"""
+
+    def __init__(self, answers=None):
+        self.answers = answers or {}
+        self.embedded = []
+        self.added = []
+        self.saves = 0
+
+    def embed(self, text):
+        self.embedded.append(text)
+        return text
+
+    def search(self, vec):
+        return self.answers.get(vec)
+
+    def add(self, vec, answer, meta):
+        self.added.append((vec, answer))
+        return True
+
+    async def save(self):
+        self.saves += 1
+
+def test_ask_semantic_hit(monkeypatch):
+    """Test that a near-duplicate question is served from the semantic cache
+
+    Both /ask and /ask/stream answer without calling Gemini and tag the
+    response with meta.cache == "semantic".
+    """
+    calls = []
+    stored = ("Use the 50/30/20 rule.", {"category": "budgeting", "timestamp": "2026-01-01T00:00:00Z"})
+    body = {"contents": [{"role": "user", "parts": [{"text": "What's a good budgeting strategy?"}]}]}
+
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_gemini("unused", calls))
+        app.state.semantic_cache = StubSemanticCache({"What's a good budgeting strategy?": stored})
+        response = client.post("/ask", json=body)
+        streamed = client.post("/ask/stream", json=body)
+
+    assert response.status_code == 200
+    assert response.json()["answer"] == "Use the 50/30/20 rule."
+    assert response.json()["meta"]["cache"] == "semantic"
+    # The age of a reused answer stays visible
+    assert response.json()["meta"]["timestamp"] == "2026-01-01T00:00:00Z"
+    frames = [f for f in streamed.text.split("\n\n") if f]
+    assert frames[0] == 'data: {"text":"Use the 50/30/20 rule."}'
+    assert json.loads(frames[1].split("data: ", 1)[1])["meta"]["cache"] == "semantic"
+    assert calls == []
+
+def test_ask_semantic_skips_multi_turn(monkeypatch):
+    """Test that follow-up questions are never matched semantically
+
+    A follow-up depends on the earlier turns, so the cache must not even be
+    consulted, nor written to with the answer.
+    """
+    cache = StubSemanticCache({"How should I budget?": ("Stale answer", {"category": "budgeting"})})
+    body = {"contents": [
+        {"role": "user", "parts": [{"text": "How should I budget?"}]},
+        {"role": "model", "parts": [{"text": "Try 50/30/20."}]},
+        {"role": "user", "parts": [{"text": "And with irregular income?"}]},
+    ]}
+
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_gemini("Budget from your lowest month."))
+        app.state.semantic_cache = cache
+        response = client.post("/ask", json=body)
+
+    assert response.json()["meta"]["cache"] == "miss"
+    assert cache.embedded == []
+    assert cache.added == []
+
+def test_ask_semantic_write_on_miss(monkeypatch):
+    """Test that a semantic miss stores the new answer and saves once add() asks for it"""
+    cache = StubSemanticCache()
+    body = {"contents": [{"role": "user", "parts": [{"text": "Is a Roth IRA worth it?"}]}]}
+    sse_body = b'data: {"candidates": [{"content": {"parts": [{"text": "Often, yes."}]}}]}\r\n\r\n'
+
+    async def mock_send(request, **kwargs):
+        return httpx.Response(status_code=200, content=sse_body)
+
+    stream_body = {"contents": [{"role": "user", "parts": [{"text": "Should I buy bonds?"}]}]}
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "post", mock_gemini("Usually, if you expect higher taxes later."))
+        monkeypatch.setattr(app.state.http, "send", mock_send)
+        app.state.semantic_cache = cache
+        response = client.post("/ask", json=body)
+        client.post("/ask/stream", json=stream_body)
+        saves = cache.saves
+
+    assert response.json()["meta"]["cache"] == "miss"
+    assert [vec for vec, _ in cache.added] == ["Is a Roth IRA worth it?", "Should I buy bonds?"]
+    assert saves == 2
+
+def test_postprocess_markdown_tables():
+    """Test table repair and bold stripping in the post-processing pass
+
+    A separator is added only under a table's header row, bold is removed
+    inside cells but kept elsewhere, and code blocks are left untouched.
+    """
+    text = (
+        "| Fund | Fee |\n"
+        "| **VTI** | 0.03% |\n"
+        "| **VXUS** | 0.07% |\n"
+        "\n"
+        "**Final Recommendation: Prefer low-fee funds.**\n"
+        "```\n"
+        "| a | b |\n"
+        "```"
+    )
+    assert main.postprocess_markdown(text) == (
+        "| Fund | Fee |\n"
+        "|----------|----------|\n"
+        "| VTI | 0.03% |\n"
+        "| VXUS | 0.07% |\n"
+        "\n"
+        "**Final Recommendation: Prefer low-fee funds.**\n"
+        "```\n"
+        "| a | b |\n"
+        "```"
+    )
+
+@pytest.mark.parametrize("text, category, investment", [
+    # Categories are ranked in CATEGORY_MAP order; the highest-ranked hit wins
+    ("Thinking about retirement", "investments", True),      # also a planning keyword
+    ("How do I save for retirement?", "personal_finance", True),
+    ("What is inflation?", "financial_literacy", False),     # also a market keyword
+    ("What does the Fed do?", "market_trends", False),
+    ("Should I open a 401(k)?", "investments", True),
+    ("Is a 529 plan worth it?", "financial_planning", False),
+    ("Hello there", "personal_finance", False),              # no hits: default
+    ("HOW DO ETFS WORK?", "investments", True),              # case-insensitive
+])
+def test_detect_category(text, category, investment):
+    """Test the category priority rules and investment detection behind the dashboard tags"""
+    assert main.detect_category(text) == category
+    assert main.is_investment_related(text) is investment
+
+@pytest.mark.parametrize("answer, present", [
+    ("Buy ETFs.\nThis is for informational purposes only and not professional financial advice.", True),
+    ("Buy ETFs.\nThis is not professional financial advice; it is for informational purposes only.", True),
+    ("Buy ETFs.\nFOR INFORMATIONAL PURPOSES ONLY.\nNot Professional Financial Advice.", True),
+    ("Buy ETFs.\nThis is for informational purposes only.", False),
+    ("Buy ETFs.\nThis is not professional financial advice.", False),
+])
+def test_ensure_disclaimer(answer, present):
+    """Test disclaimer detection: both phrases, in either order and any case
+
+    An investment answer missing either phrase gets the full disclaimer appended;
+    one with both is returned unchanged.
+    """
+    result, has = main.ensure_disclaimer(answer)
+    assert has is True
+    if present:
+        assert result == answer
+    else:
+        assert result.endswith(main.DISCLAIMER_TEXT)
+
+def test_ask_stream(monkeypatch):
+    """Test SSE streaming of Gemini chunks followed by a final meta event
+
+    Raw text chunks are forwarded as they arrive; the post-processed answer
+    and metadata arrive in the closing `event: meta` frame.
+    """
+    sse_body = (
+        b'data: {"candidates": [{"content": {"parts": [{"text": "Save 20% "}]}}]}\r\n\r\n'
+        b'data: {"candidates": [{"content": {"parts": [{"text": "of income."}]}}]}\r\n\r\n'
+    )
+
+    async def mock_send(request, **kwargs):
+        assert ":streamGenerateContent?alt=sse" in str(request.url)
+        return httpx.Response(status_code=200, content=sse_body)
+
+    body = {"contents": [{"role": "user", "parts": [{"text": "How much should I save?"}]}]}
+    with TestClient(app) as client:
+        monkeypatch.setattr(app.state.http, "send", mock_send)
+        response = client.post("/ask/stream", json=body)
+        replayed = client.post("/ask/stream", json=body)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    frames = [f for f in response.text.split("\n\n") if f]
+    assert frames[0] == 'data: {"text":"Save 20% "}'
+    assert frames[1] == 'data: {"text":"of income."}'
+    assert frames[2].startswith("event: meta\ndata: ")
+    final = json.loads(frames[2].split("data: ", 1)[1])
+    assert final["answer"] == "Save 20% of income."
+    assert final["meta"]["category"] == "personal_finance"
+
+    # The completed answer is cached and replayed without another upstream call
+    replay_frames = [f for f in replayed.text.split("\n\n") if f]
+    assert replay_frames[0] == 'data: {"text":"Save 20% of income."}'
+    assert json.loads(replay_frames[1].split("data: ", 1)[1])["meta"]["cache"] == "hit"
+
+def test_ask_single_flight(monkeypatch):
+    """Test that concurrent identical requests share one Gemini call
+
+    While the first request is waiting on Gemini, an identical second one
+    must await the same result instead of issuing its own call.
+    """
+    calls = []
+
+    class SlowClient:
+        async def aclose(self):
+            pass
+
+        async def post(self, url, **kwargs):
+            calls.append(url)
+            await asyncio.sleep(0.1)
+            return gemini_response("Pay the highest-APR debt first.")
+
+    body = {"contents": [{"role": "user", "parts": [{"text": "Which debt should I pay off first?"}]}]}
+
+    async def run():
+        # Run the lifespan on this loop, then swap in the slow upstream
+        async with main.lifespan(app):
+            await app.state.http.aclose()
+            app.state.http = SlowClient()
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                return await asyncio.gather(ac.post("/ask", json=body), ac.post("/ask", json=body))
+
+    first, second = (r.json() for r in asyncio.run(run()))
+    assert len(calls) == 1
+    assert first["answer"] == second["answer"]
+    assert sorted([first["meta"]["cache"], second["meta"]["cache"]]) == ["coalesced", "miss"]
+    assert main.INFLIGHT == {}
+
+    # A leader cancelled mid-call (client gone) must not cancel its waiters too
+    other = {"contents": [{"role": "user", "parts": [{"text": "Should I consolidate my loans?"}]}]}
+
+    async def run_leader_cancelled():
+        async with main.lifespan(app):
+            await app.state.http.aclose()
+            app.state.http = SlowClient()
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                leader = asyncio.create_task(ac.post("/ask", json=other))
+                await asyncio.sleep(0.01)
+                waiter = asyncio.create_task(ac.post("/ask", json=other))
+                await asyncio.sleep(0.01)
+                leader.cancel()
+                return await waiter
+
+    waiter = asyncio.run(run_leader_cancelled())
+    assert waiter.status_code == 503
+    assert main.INFLIGHT == {}
+
+class PromptCacheClient:
+    """Fake Gemini client for the cachedContents endpoints
+
+    create_statuses / extend_statuses are consumed one per call (the last value
+    repeats); an Exception in extend_statuses is raised instead of answered.
+    """
+
+    def __init__(self, create_statuses=(200,), extend_statuses=(200,)):
+        self.create_statuses = list(create_statuses)
+        self.extend_statuses = list(extend_statuses)
+        self.calls = []
+
+    @staticmethod
+    def _next(statuses):
+        return statuses.pop(0) if len(statuses) > 1 else statuses[0]
+
+    async def aclose(self):
+        pass
+
+    async def post(self, url, **kwargs):
+        self.calls.append(("POST", url))
+        status = self._next(self.create_statuses)
+        name = f"cachedContents/prompt-{len(self.calls)}"
+        return httpx.Response(status_code=status, json={"name": name} if status == 200 else {})
+
+    async def patch(self, url, **kwargs):
+        self.calls.append(("PATCH", url))
+        status = self._next(self.extend_statuses)
+        if isinstance(status, Exception):
+            raise status
+        return httpx.Response(status_code=status, json={})
+
+    async def delete(self, url, **kwargs):
+        self.calls.append(("DELETE", url))
+        return httpx.Response(status_code=200, json={})
+
+def run_prompt_cache(monkeypatch, fake, until):
+    """Run the lifespan with context caching on until until() holds; return the payload then"""
+    monkeypatch.setattr(main, "CONTEXT_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "CONTEXT_CACHE_REFRESH", 0.01)
+
+    async def run():
+        async with main.lifespan(app):
+            # Swap before the refresh task gets its first turn on the loop
+            real, app.state.http = app.state.http, fake
+            await real.aclose()
+            for _ in range(200):
+                if until():
+                    break
+                await asyncio.sleep(0.01)
+            return main.build_payload([{"role": "user", "parts": [{"text": "Hi"}]}])
+
+    return asyncio.run(run())
+
+def test_prompt_cache_recovers_and_is_deleted(monkeypatch):
+    """Test that a failing refresh resets the cache name and shutdown deletes the entry
+
+    An unexpected error must not kill the refresh task with a stale name in place,
+    and a stopped worker must not leave a billed cachedContent behind.
+    """
+    fake = PromptCacheClient(extend_statuses=(RuntimeError("boom"), 200))
+    payload = run_prompt_cache(monkeypatch, fake, lambda: app.state.cached_prompt == "cachedContents/prompt-3")
+
+    assert payload["cachedContent"] == "cachedContents/prompt-3"
+    assert fake.calls[:3] == [
+        ("POST", f"{main.GEMINI_API_BASE}/cachedContents"),
+        ("PATCH", f"{main.GEMINI_API_BASE}/cachedContents/prompt-1?updateMask=ttl"),
+        ("POST", f"{main.GEMINI_API_BASE}/cachedContents"),
+    ]
+    assert fake.calls[-1] == ("DELETE", f"{main.GEMINI_API_BASE}/cachedContents/prompt-3")
+    assert app.state.cached_prompt is None
+
+def test_prompt_cache_used_in_payload(monkeypatch):
+    """Test that a created context cache replaces the inline system instruction"""
+    fake = PromptCacheClient()
+    payload = run_prompt_cache(monkeypatch, fake, lambda: app.state.cached_prompt is not None)
+
+    assert payload["cachedContent"] == "cachedContents/prompt-1"
+    assert "systemInstruction" not in payload
+    assert payload["contents"][0]["parts"][0]["text"] == "Hi"
+
+def test_prompt_cache_refused_falls_back(monkeypatch):
+    """Test that requests keep the inline system instruction when Gemini refuses the cache"""
+    fake = PromptCacheClient(create_statuses=(400,))
+    payload = run_prompt_cache(monkeypatch, fake, lambda: len(fake.calls) >= 2)
+
+    assert payload == {
+        "systemInstruction": main.SYSTEM_INSTRUCTION,
+        "contents": [{"role": "user", "parts": [{"text": "Hi"}]}],
+    }
+    # Nothing was created, so nothing is deleted on shutdown
+    assert all(method == "POST" for method, _ in fake.calls)
+
+def test_prompt_cache_recreated_when_extend_fails(monkeypatch):
+    """Test that an entry Gemini no longer knows about is replaced by a new one"""
+    fake = PromptCacheClient(extend_statuses=(404, 200))
+    payload = run_prompt_cache(monkeypatch, fake, lambda: app.state.cached_prompt == "cachedContents/prompt-3")
+
+    assert [method for method, _ in fake.calls[:3]] == ["POST", "PATCH", "POST"]
+    assert payload["cachedContent"] == "cachedContents/prompt-3"
+
+def test_semantic_cache_persistence(tmp_path):
+    """Test the semantic cache round-trips through its file and rejects a mismatched one
+
+    Loading vectors next to entries from a different writer would serve the answer
+    to another question, so an inconsistent file must come back empty.
+    """
+    faiss = pytest.importorskip("faiss")
+    np = pytest.importorskip("numpy")
+
+    now = time.time()
+    vectors = np.eye(2, 4, dtype="float32")
+    entries = [("Answer A", {"category": "budgeting"}, now), ("Answer B", {"category": "debt"}, now)]
+    index = faiss.IndexFlatIP(4)
+    index.add(vectors)
+    cache = main.SemanticCache(None, index, list(entries), str(tmp_path))
+    cache._unsaved = 2
+    asyncio.run(cache.save())
+
+    index, loaded = main.SemanticCache.read(str(tmp_path), 4)
+    assert index.ntotal == 2
+    assert loaded == entries
+
+    # Vectors from one worker, entries from another
+    with open(tmp_path / main.SemanticCache.FILE_NAME, "wb") as f:
+        np.savez(f, vectors=vectors, entries=np.frombuffer(orjson.dumps(entries[:1]), dtype=np.uint8))
+    index, loaded = main.SemanticCache.read(str(tmp_path), 4)
+    assert index.ntotal == 0
+    assert loaded == []
+
+def test_semantic_cache_expiry_and_eviction(tmp_path, monkeypatch):
+    """Test that old answers are never served and a full cache evicts its oldest entries
+
+    Expired entries are dropped on load, market answers are not cached at all,
+    and new answers still get in once MAX_ENTRIES is reached.
+    """
+    faiss = pytest.importorskip("faiss")
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(main.SemanticCache, "MAX_ENTRIES", 2)
+
+    vectors = np.eye(3, 4, dtype="float32")
+    old = time.time() - main.SemanticCache.TTL - 1
+    index = faiss.IndexFlatIP(4)
+    index.add(vectors[:1])
+    cache = main.SemanticCache(None, index, [("Stale", {"category": "budgeting"}, old)], str(tmp_path))
+
+    # An expired answer is a miss even on an exact vector match
+    assert cache.search(vectors[:1]) is None
+    assert not cache.add(vectors[1:2], "Gold hit a record today", {"category": "market_trends"})
+    assert cache.index.ntotal == 1
+
+    # Adding expires the stale entry, then the full cache evicts its oldest
+    cache.add(vectors[1:2], "Answer B", {"category": "debt"})
+    assert [e[0] for e in cache.entries] == ["Answer B"]
+    cache.add(vectors[0:1], "Answer A", {"category": "budgeting"})
+    cache.add(vectors[2:3], "Answer C", {"category": "investments"})
+    assert [e[0] for e in cache.entries] == ["Answer A", "Answer C"]
+    assert cache.search(vectors[2:3]) == ("Answer C", {"category": "investments"})
+    assert cache.search(vectors[1:2]) is None
+
+    # Entries that expire while on disk are dropped on load
+    cache.entries[0] = ("Answer A", {"category": "budgeting"}, old)
+    cache._write(cache.index.reconstruct_n(0, cache.index.ntotal), cache.entries)
+    index, loaded = main.SemanticCache.read(str(tmp_path), 4)
+    assert [e[0] for e in loaded] == ["Answer C"]
+    assert index.ntotal == 1